@@ -1,10 +1,19 @@
-import json
 import logging
+import threading
+import time
+from collections import namedtuple
 from enum import Enum
 
 import re
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import urllib3
+from requests.adapters import HTTPAdapter
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 from kube_hunter.conf import config
 from kube_hunter.core.events import handler
@@ -26,6 +35,72 @@ from kube_hunter.modules.discovery.kubelet import (
 logger = logging.getLogger(__name__)
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# shared connection pool, so keep-alive connections are reused across hunters and endpoints
+_ADAPTER = HTTPAdapter(pool_connections=50, pool_maxsize=100)
+_SESSION = requests.Session()
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
+
+# parsed /pods responses, keyed by kubelet and credentials,
+# so hunters probing the same kubelet within PODS_CACHE_TTL seconds share one fetch
+PODS_CACHE_TTL = 30
+PODS_CACHE_SIZE = 256
+_pods_cache = dict()
+_pods_cache_lock = threading.Lock()
+
+
+def clear_pods_cache():
+    with _pods_cache_lock:
+        _pods_cache.clear()
+
+
+def get_pods(session, base_url, timeout):
+    """Returns the parsed /pods response of the kubelet at base_url, or None if it's not accessible.
+    Successful responses are cached for PODS_CACHE_TTL seconds, failures are not cached"""
+    key = (base_url, session.headers.get("Authorization"))
+    with _pods_cache_lock:
+        cached = _pods_cache.get(key)
+    if cached and time.monotonic() - cached[0] < PODS_CACHE_TTL:
+        return cached[1]
+
+    response = session.get(f"{base_url}/{KubeletHandlers.PODS.value}", verify=False, timeout=timeout)
+    if response.status_code != 200 or not response.headers.get("Content-Type", "").startswith("application/json"):
+        return None
+    pods = json_loads(response.content)
+    if "items" not in pods:
+        return None
+    with _pods_cache_lock:
+        _pods_cache.pop(key, None)
+        if len(_pods_cache) >= PODS_CACHE_SIZE:
+            # evicting the oldest entry
+            _pods_cache.pop(next(iter(_pods_cache)))
+        _pods_cache[key] = (time.monotonic(), pods)
+    return pods
+
+
+# shared default for missing pod fields, saves allocating an empty dict per lookup. never modified
+_EMPTY = dict()
+
+PodContainer = namedtuple("PodContainer", ["namespace", "pod", "name", "phase", "privileged"])
+
+
+def get_containers(pods):
+    """Flattens a parsed /pods response into a list of PodContainer,
+    keeping only the fields the hunters look at"""
+    if not pods:
+        return []
+    return [
+        PodContainer(
+            pod["metadata"]["namespace"],
+            pod["metadata"]["name"],
+            container["name"],
+            pod.get("status", _EMPTY).get("phase"),
+            bool(container.get("securityContext", _EMPTY).get("privileged")),
+        )
+        for pod in pods["items"]
+        for container in pod["spec"]["containers"]
+    ]
+
 
 """ Vulnerabilities """
 
@@ -175,6 +250,9 @@ class KubeletHandlers(Enum):
     PPROF_CMDLINE = "debug/pprof/cmdline"
 
 
+GIT_VERSION_PATTERN = re.compile(rb'gitVersion="([^"]+)"')
+
+
 @handler.subscribe(ReadOnlyKubeletEvent)
 class ReadOnlyKubeletPortHunter(Hunter):
     """Kubelet Readonly Ports Hunter
@@ -183,45 +261,52 @@ class ReadOnlyKubeletPortHunter(Hunter):
 
     def __init__(self, event):
         self.event = event
+        self.session = _SESSION
+        self.timeout = config.network_timeout
         self.path = f"http://{self.event.host}:{self.event.port}"
         self.pods_endpoint_data = ""
+        self.containers = []
 
     def get_k8s_version(self):
         logger.debug("Passive hunter is attempting to find kubernetes version")
-        metrics = requests.get(f"{self.path}/metrics", timeout=config.network_timeout).text
-        for line in metrics.split("\n"):
-            if line.startswith("kubernetes_build_info"):
-                for info in line[line.find("{") + 1 : line.find("}")].split(","):
-                    k, v = info.split("=")
-                    if k == "gitVersion":
-                        return v.strip('"')
+        with self.session.get(f"{self.path}/metrics", stream=True, verify=False, timeout=self.timeout) as metrics:
+            # the build info is a single line, no need to read the rest of the metrics.
+            # returning early closes the connection instead of returning it to the pool,
+            # a reconnect is cheaper than downloading the rest of a large /metrics response
+            for line in metrics.iter_lines():
+                if line.startswith(b"kubernetes_build_info"):
+                    match = GIT_VERSION_PATTERN.search(line)
+                    return match.group(1).decode() if match else None
 
     # returns list of tuples of Privileged container and their pod.
     def find_privileged_containers(self):
         logger.debug("Trying to find privileged containers and their pods")
-        privileged_containers = []
-        if self.pods_endpoint_data:
-            for pod in self.pods_endpoint_data["items"]:
-                for container in pod["spec"]["containers"]:
-                    if container.get("securityContext", {}).get("privileged"):
-                        privileged_containers.append((pod["metadata"]["name"], container["name"]))
-        return privileged_containers if len(privileged_containers) > 0 else None
+        privileged_containers = [
+            (container.pod, container.name) for container in self.containers if container.privileged
+        ]
+        return privileged_containers or None
 
     def get_pods_endpoint(self):
         logger.debug("Attempting to find pods endpoints")
-        response = requests.get(f"{self.path}/pods", timeout=config.network_timeout)
-        if "items" in response.text:
-            return response.json()
+        return get_pods(self.session, self.path, self.timeout)
 
+    # kept for the reported health status, although access is already implied by the read only port.
+    # it is fetched alongside /pods and /metrics, so it doesn't add to the hunt's duration
     def check_healthz_endpoint(self):
-        r = requests.get(f"{self.path}/healthz", verify=False, timeout=config.network_timeout)
+        r = self.session.get(f"{self.path}/healthz", verify=False, timeout=self.timeout)
         return r.text if r.status_code == 200 else False
 
     def execute(self):
-        self.pods_endpoint_data = self.get_pods_endpoint()
-        k8s_version = self.get_k8s_version()
+        # the endpoints are independent of each other, so they are fetched concurrently
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            pods_future = executor.submit(self.get_pods_endpoint)
+            k8s_version_future = executor.submit(self.get_k8s_version)
+            healthz_future = executor.submit(self.check_healthz_endpoint)
+        self.pods_endpoint_data = pods_future.result()
+        self.containers = get_containers(self.pods_endpoint_data)
+        k8s_version = k8s_version_future.result()
         privileged_containers = self.find_privileged_containers()
-        healthz = self.check_healthz_endpoint()
+        healthz = healthz_future.result()
         if k8s_version:
             self.publish_event(
                 K8sVersionDisclosure(version=k8s_version, from_endpoint="/metrics", extra_info="on Kubelet")
@@ -243,32 +328,47 @@ class SecureKubeletPortHunter(Hunter):
     class DebugHandlers(object):
         """ all methods will return the handler name if successful """
 
-        def __init__(self, path, pod, session=None):
+        # handler paths that don't depend on the probed pod are rendered once, at class creation
+        RUN_PATH = KubeletHandlers.RUN.value.format(pod_namespace="test", pod_id="test", container_name="test", cmd="")
+        LOGS_PATH = KubeletHandlers.LOGS.value.format(path="")
+
+        def __init__(self, path, pod, session=None, timeout=None):
             self.path = path
-            self.session = session if session else requests.Session()
+            self.session = session if session else _SESSION
             self.pod = pod
+            self.timeout = timeout if timeout else config.network_timeout
+
+            # the pod is fixed for the handlers' lifetime, so the urls are rendered once
+            pod_fields = {
+                "pod_namespace": pod["namespace"],
+                "pod_id": pod["name"],
+                "container_name": pod["container"],
+                "cmd": "",
+                "port": 80,
+            }
+            self.container_logs_url = path + KubeletHandlers.CONTAINERLOGS.value.format_map(pod_fields)
+            self.exec_url = path + KubeletHandlers.EXEC.value.format_map(pod_fields)
+            self.port_forward_url = path + KubeletHandlers.PORTFORWARD.value.format_map(pod_fields)
+            self.attach_url = path + KubeletHandlers.ATTACH.value.format_map(pod_fields)
+            self.run_url = path + self.RUN_PATH
+            self.running_pods_url = path + KubeletHandlers.RUNNINGPODS.value
+            self.logs_url = path + self.LOGS_PATH
+            self.pprof_cmdline_url = path + KubeletHandlers.PPROF_CMDLINE.value
 
         # outputs logs from a specific container
         def test_container_logs(self):
-            logs_url = self.path + KubeletHandlers.CONTAINERLOGS.value.format(
-                pod_namespace=self.pod["namespace"], pod_id=self.pod["name"], container_name=self.pod["container"],
-            )
-            return self.session.get(logs_url, verify=False, timeout=config.network_timeout).status_code == 200
+            # only the status is needed, the logs themselves are never read
+            with self.session.get(self.container_logs_url, stream=True, verify=False, timeout=self.timeout) as r:
+                return r.status_code == 200
 
         # need further investigation on websockets protocol for further implementation
         def test_exec_container(self):
             # opens a stream to connect to using a web socket
             headers = {"X-Stream-Protocol-Version": "v2.channel.k8s.io"}
-            exec_url = self.path + KubeletHandlers.EXEC.value.format(
-                pod_namespace=self.pod["namespace"],
-                pod_id=self.pod["name"],
-                container_name=self.pod["container"],
-                cmd="",
-            )
             return (
                 "/cri/exec/"
                 in self.session.get(
-                    exec_url, headers=headers, allow_redirects=False, verify=False, timeout=config.network_timeout,
+                    self.exec_url, headers=headers, allow_redirects=False, verify=False, timeout=self.timeout,
                 ).text
             )
 
@@ -281,89 +381,95 @@ class SecureKubeletPortHunter(Hunter):
                 "Sec-Websocket-Version": "13",
                 "Sec-Websocket-Protocol": "SPDY",
             }
-            pf_url = self.path + KubeletHandlers.PORTFORWARD.value.format(
-                pod_namespace=self.pod["namespace"], pod_id=self.pod["name"], port=80,
-            )
-            self.session.get(
-                pf_url, headers=headers, verify=False, stream=True, timeout=config.network_timeout,
-            ).status_code == 200
+            with self.session.get(
+                self.port_forward_url, headers=headers, stream=True, verify=False, timeout=self.timeout,
+            ):
+                pass
             # TODO: what to return?
 
         # executes one command and returns output
         def test_run_container(self):
-            run_url = self.path + KubeletHandlers.RUN.value.format(
-                pod_namespace="test", pod_id="test", container_name="test", cmd="",
-            )
             # if we get a Method Not Allowed, we know we passed Authentication and Authorization.
-            return self.session.get(run_url, verify=False, timeout=config.network_timeout).status_code == 405
+            # HEAD isn't mapped to an authorization verb by the kubelet, so GET is used, without reading the body
+            with self.session.get(self.run_url, stream=True, verify=False, timeout=self.timeout) as r:
+                return r.status_code == 405
 
         # returns list of currently running pods
         def test_running_pods(self):
-            pods_url = self.path + KubeletHandlers.RUNNINGPODS.value
-            r = self.session.get(pods_url, verify=False, timeout=config.network_timeout)
-            return r.json() if r.status_code == 200 else False
+            r = self.session.get(self.running_pods_url, verify=False, timeout=self.timeout)
+            return json_loads(r.content) if r.status_code == 200 else False
 
         # need further investigation on the differences between attach and exec
         def test_attach_container(self):
             # headers={"X-Stream-Protocol-Version": "v2.channel.k8s.io"}
-            attach_url = self.path + KubeletHandlers.ATTACH.value.format(
-                pod_namespace=self.pod["namespace"],
-                pod_id=self.pod["name"],
-                container_name=self.pod["container"],
-                cmd="",
-            )
             return (
                 "/cri/attach/"
                 in self.session.get(
-                    attach_url, allow_redirects=False, verify=False, timeout=config.network_timeout,
+                    self.attach_url, allow_redirects=False, verify=False, timeout=self.timeout,
                 ).text
             )
 
         # checks access to logs endpoint
         def test_logs_endpoint(self):
-            logs_url = self.session.get(
-                self.path + KubeletHandlers.LOGS.value.format(path=""), timeout=config.network_timeout,
-            ).text
-            return "<pre>" in logs_url
+            # the directory listing starts with <pre>, so only its beginning is read
+            with self.session.get(self.logs_url, stream=True, verify=False, timeout=self.timeout) as r:
+                return b"<pre>" in next(r.iter_content(256), b"")
 
         # returns the cmd line used to run the kubelet
         def test_pprof_cmdline(self):
-            cmd = self.session.get(
-                self.path + KubeletHandlers.PPROF_CMDLINE.value, verify=False, timeout=config.network_timeout,
-            )
+            cmd = self.session.get(self.pprof_cmdline_url, verify=False, timeout=self.timeout)
             return cmd.text if cmd.status_code == 200 else None
 
+    # debug handlers probes, and the vulnerability to publish from each one's successful result
+    PROBES = (
+        ("test_running_pods", lambda running_pods: ExposedRunningPodsHandler(count=len(running_pods["items"]))),
+        ("test_pprof_cmdline", lambda cmdline: ExposedKubeletCmdline(cmdline=cmdline)),
+        ("test_container_logs", lambda _: ExposedContainerLogsHandler()),
+        ("test_exec_container", lambda _: ExposedExecHandler()),
+        ("test_run_container", lambda _: ExposedRunHandler()),
+        ("test_port_forward", lambda _: ExposedPortForwardHandler()),  # not implemented
+        ("test_attach_container", lambda _: ExposedAttachHandler()),
+        ("test_logs_endpoint", lambda _: ExposedSystemLogs()),
+    )
+
     def __init__(self, event):
         self.event = event
+        # a session per event keeps the auth token scoped to this kubelet,
+        # while connections to it are still drawn from the shared pool
         self.session = requests.Session()
+        self.session.mount("https://", _ADAPTER)
         if self.event.secure:
             self.session.headers.update({"Authorization": f"Bearer {self.event.auth_token}"})
             # self.session.cert = self.event.client_cert
         # copy session to event
         self.event.session = self.session
-        self.path = "https://{self.event.host}:10250"
+        self.timeout = config.network_timeout
+        self.path = f"https://{self.event.host}:{self.event.port}"
         self.kubehunter_pod = {
             "name": "kube-hunter",
             "namespace": "default",
             "container": "kube-hunter",
         }
         self.pods_endpoint_data = ""
+        self.containers = []
 
     def get_pods_endpoint(self):
-        response = self.session.get(f"{self.path}/pods", verify=False, timeout=config.network_timeout)
-        if "items" in response.text:
-            return response.json()
+        return get_pods(self.session, self.path, self.timeout)
 
     def check_healthz_endpoint(self):
-        r = requests.get(f"{self.path}/healthz", verify=False, timeout=config.network_timeout)
+        r = self.session.get(f"{self.path}/healthz", verify=False, timeout=self.timeout)
         return r.text if r.status_code == 200 else False
 
     def execute(self):
         if self.event.anonymous_auth:
             self.publish_event(AnonymousAuthEnabled())
 
-        self.pods_endpoint_data = self.get_pods_endpoint()
-        healthz = self.check_healthz_endpoint()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            pods_future = executor.submit(self.get_pods_endpoint)
+            healthz_future = executor.submit(self.check_healthz_endpoint)
+        self.pods_endpoint_data = pods_future.result()
+        self.containers = get_containers(self.pods_endpoint_data)
+        healthz = healthz_future.result()
         if self.pods_endpoint_data:
             self.publish_event(ExposedPodsHandler(pods=self.pods_endpoint_data["items"]))
         if healthz:
@@ -374,53 +480,44 @@ class SecureKubeletPortHunter(Hunter):
         # if kube-hunter runs in a pod, we test with kube-hunter's pod
         pod = self.kubehunter_pod if config.pod else self.get_random_pod()
         if pod:
-            debug_handlers = self.DebugHandlers(self.path, pod, self.session)
-            try:
-                # TODO: use named expressions, introduced in python3.8
-                running_pods = debug_handlers.test_running_pods()
-                if running_pods:
-                    self.publish_event(ExposedRunningPodsHandler(count=len(running_pods["items"])))
-                cmdline = debug_handlers.test_pprof_cmdline()
-                if cmdline:
-                    self.publish_event(ExposedKubeletCmdline(cmdline=cmdline))
-                if debug_handlers.test_container_logs():
-                    self.publish_event(ExposedContainerLogsHandler())
-                if debug_handlers.test_exec_container():
-                    self.publish_event(ExposedExecHandler())
-                if debug_handlers.test_run_container():
-                    self.publish_event(ExposedRunHandler())
-                if debug_handlers.test_port_forward():
-                    self.publish_event(ExposedPortForwardHandler())  # not implemented
-                if debug_handlers.test_attach_container():
-                    self.publish_event(ExposedAttachHandler())
-                if debug_handlers.test_logs_endpoint():
-                    self.publish_event(ExposedSystemLogs())
-            except Exception:
-                logger.debug("Failed testing debug handlers", exc_info=True)
+            debug_handlers = self.DebugHandlers(f"{self.path}/", pod, self.session, self.timeout)
+            # the probes are independent of each other, so they are sent concurrently
+            results = dict()
+            with ThreadPoolExecutor(max_workers=len(self.PROBES)) as executor:
+                futures = {executor.submit(getattr(debug_handlers, probe)): probe for probe, _ in self.PROBES}
+                for future in as_completed(futures):
+                    try:
+                        results[futures[future]] = future.result()
+                    except Exception:
+                        logger.debug(f"Failed testing debug handler {futures[future]}", exc_info=True)
+
+            for probe, vulnerability in self.PROBES:
+                result = results.get(probe)
+                if result:
+                    try:
+                        self.publish_event(vulnerability(result))
+                    except Exception:
+                        logger.debug(f"Failed publishing the result of debug handler {probe}", exc_info=True)
 
     # trying to get a pod from default namespace, if doesn't exist, gets a kube-system one
     def get_random_pod(self):
-        if self.pods_endpoint_data:
-            pods_data = self.pods_endpoint_data["items"]
-
-            def is_default_pod(pod):
-                return pod["metadata"]["namespace"] == "default" and pod["status"]["phase"] == "Running"
-
-            def is_kubesystem_pod(pod):
-                return pod["metadata"]["namespace"] == "kube-system" and pod["status"]["phase"] == "Running"
-
-            pod_data = next(filter(is_default_pod, pods_data), None)
-            if not pod_data:
-                pod_data = next(filter(is_kubesystem_pod, pods_data), None)
-
-            if pod_data:
-                container_data = next(pod_data["spec"]["containers"], None)
-                if container_data:
-                    return {
-                        "name": pod_data["metadata"]["name"],
-                        "container": container_data["name"],
-                        "namespace": pod_data["metadata"]["namespace"],
-                    }
+        default_container = kubesystem_container = None
+        for container in self.containers:
+            if container.phase != "Running":
+                continue
+            if container.namespace == "default":
+                default_container = container
+                break
+            if container.namespace == "kube-system" and not kubesystem_container:
+                kubesystem_container = container
+
+        container = default_container or kubesystem_container
+        if container:
+            return {
+                "name": container.pod,
+                "container": container.name,
+                "namespace": container.namespace,
+            }
 
 
 @handler.subscribe(ExposedRunHandler)
@@ -432,6 +529,7 @@ class ProveRunHandler(ActiveHunter):
     def __init__(self, event):
         self.event = event
         self.base_path = f"https://{self.event.host}:{self.event.port}"
+        self.timeout = config.network_timeout
 
     def run(self, command, container):
         run_url = KubeletHandlers.RUN.value.format(
@@ -441,17 +539,15 @@ class ProveRunHandler(ActiveHunter):
             cmd=command,
         )
         return self.event.session.post(
-            f"{self.base_path}/{run_url}", verify=False, timeout=config.network_timeout,
+            f"{self.base_path}/{run_url}", verify=False, timeout=self.timeout,
         ).text
 
     def execute(self):
-        r = self.event.session.get(
-            self.base_path + KubeletHandlers.PODS.value, verify=False, timeout=config.network_timeout,
-        )
-        if "items" in r.text:
-            pods_data = r.json()["items"]
+        pods = get_pods(self.event.session, self.base_path, self.timeout)
+        if pods:
+            pods_data = pods["items"]
             for pod_data in pods_data:
-                container_data = next(pod_data["spec"]["containers"])
+                container_data = next(iter(pod_data["spec"]["containers"]), None)
                 if container_data:
                     output = self.run(
                         "uname -a",
@@ -475,19 +571,18 @@ class ProveContainerLogsHandler(ActiveHunter):
     def __init__(self, event):
         self.event = event
         protocol = "https" if self.event.port == 10250 else "http"
-        self.base_url = f"{protocol}://{self.event.host}:{self.event.port}/"
+        self.base_url = f"{protocol}://{self.event.host}:{self.event.port}"
+        self.timeout = config.network_timeout
 
     def execute(self):
-        pods_raw = self.event.session.get(
-            self.base_url + KubeletHandlers.PODS.value, verify=False, timeout=config.network_timeout,
-        ).text
-        if "items" in pods_raw:
-            pods_data = json.loads(pods_raw)["items"]
+        pods = get_pods(self.event.session, self.base_url, self.timeout)
+        if pods:
+            pods_data = pods["items"]
             for pod_data in pods_data:
-                container_data = next(pod_data["spec"]["containers"])
+                container_data = next(iter(pod_data["spec"]["containers"]), None)
                 if container_data:
                     container_name = container_data["name"]
-                    output = requests.get(
+                    output = self.event.session.get(
                         f"{self.base_url}/"
                         + KubeletHandlers.CONTAINERLOGS.value.format(
                             pod_namespace=pod_data["metadata"]["namespace"],
@@ -495,13 +590,16 @@ class ProveContainerLogsHandler(ActiveHunter):
                             container_name=container_name,
                         ),
                         verify=False,
-                        timeout=config.network_timeout,
+                        timeout=self.timeout,
                     )
                     if output.status_code == 200 and output.text:
                         self.event.evidence = f"{container_name}: {output.text}"
                         return
 
 
+PROCTITLE_PATTERN = re.compile(rb"proctitle=([0-9A-Fa-f]+)")
+
+
 @handler.subscribe(ExposedSystemLogs)
 class ProveSystemLogs(ActiveHunter):
     """Kubelet System Logs Hunter
@@ -511,17 +609,23 @@ class ProveSystemLogs(ActiveHunter):
     def __init__(self, event):
         self.event = event
         self.base_url = f"https://{self.event.host}:{self.event.port}"
+        self.timeout = config.network_timeout
 
     def execute(self):
         audit_logs = self.event.session.get(
             f"{self.base_url}/" + KubeletHandlers.LOGS.value.format(path="audit/audit.log"),
             verify=False,
-            timeout=config.network_timeout,
-        ).text
+            timeout=self.timeout,
+        ).content
         logger.debug(f"Audit log of host {self.event.host}: {audit_logs[:10]}")
         # iterating over proctitles and converting them into readable strings
         proctitles = []
-        for proctitle in re.findall(r"proctitle=(\w+)", audit_logs):
-            proctitles.append(bytes.fromhex(proctitle).decode("utf-8").replace("\x00", " "))
+        for match in PROCTITLE_PATTERN.finditer(audit_logs):
+            try:
+                proctitle = bytes.fromhex(match.group(1).decode("ascii"))
+            except ValueError:
+                logger.debug(f"Skipping malformed proctitle {match.group(1)[:20]}")
+                continue
+            proctitles.append(proctitle.replace(b"\x00", b" ").decode("utf-8", "replace"))
         self.event.proctitles = proctitles
         self.event.evidence = f"audit log: {proctitles}"
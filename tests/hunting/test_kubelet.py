@@ -0,0 +1,250 @@
+import json
+import pytest
+import requests
+import requests_mock
+
+from kube_hunter.modules.discovery.kubelet import ReadOnlyKubeletEvent, SecureKubeletEvent
+from kube_hunter.modules.hunting import kubelet
+from kube_hunter.modules.hunting.kubelet import (
+    ReadOnlyKubeletPortHunter,
+    SecureKubeletPortHunter,
+    ProveRunHandler,
+    ProveSystemLogs,
+    ExposedRunHandler,
+    ExposedSystemLogs,
+    get_containers,
+    get_pods,
+    clear_pods_cache,
+)
+
+pods = """{"items":[
+    {"metadata":{"name":"podA", "namespace":"kube-system"},
+     "status":{"phase":"Running"},
+     "spec":{"containers":[{"name":"containerA"}]}},
+    {"metadata":{"name":"podB", "namespace":"default"},
+     "status":{"phase":"Running"},
+     "spec":{"containers":[{"name":"containerB"}, {"name":"containerC", "securityContext":{"privileged":true}}]}}
+]}"""
+
+
+@pytest.fixture(autouse=True)
+def pods_cache():
+    clear_pods_cache()
+    yield
+    clear_pods_cache()
+
+
+def create_secure_event():
+    e = SecureKubeletEvent(secure=False)
+    e.host = "kubelet"
+    e.port = 10250
+    return e
+
+
+def test_SecureKubeletPortHunter_path():
+    h = SecureKubeletPortHunter(create_secure_event())
+    assert "{" not in h.path
+    assert h.path == "https://kubelet:10250"
+
+
+def test_SecureKubeletPortHunter_get_random_pod():
+    h = SecureKubeletPortHunter(create_secure_event())
+    with requests_mock.Mocker() as m:
+        m.get(
+            "https://kubelet:10250/pods", text=pods, headers={"Content-Type": "application/json"},
+        )
+        m.get("https://kubelet:10250/healthz", text="ok")
+        h.test_handlers = lambda: None
+        h.publish_event = lambda event: None
+        h.execute()
+
+    assert h.get_random_pod() == {"name": "podB", "container": "containerB", "namespace": "default"}
+
+
+def test_ProveRunHandler():
+    e = ExposedRunHandler()
+    e.previous = create_secure_event()
+    SecureKubeletPortHunter(e.previous)
+    h = ProveRunHandler(e)
+    with requests_mock.Mocker() as m:
+        pods_request = m.get(
+            "https://kubelet:10250/pods", text=pods, headers={"Content-Type": "application/json"},
+        )
+        m.post(
+            "https://kubelet:10250/run/kube-system/podA/containerA?cmd=uname -a", text="Linux kubelet",
+        )
+        h.execute()
+
+    assert pods_request.call_count == 1
+    assert e.evidence == "uname -a: Linux kubelet"
+
+
+def test_DebugHandlers_urls():
+    debug_handlers = SecureKubeletPortHunter.DebugHandlers(
+        "https://kubelet:10250/", {"name": "podA", "namespace": "default", "container": "containerA"}, timeout=1,
+    )
+    assert debug_handlers.container_logs_url == "https://kubelet:10250/containerLogs/default/podA/containerA"
+    assert debug_handlers.exec_url == (
+        "https://kubelet:10250/exec/default/podA/containerA?command=&input=1&output=1&tty=1"
+    )
+    assert debug_handlers.port_forward_url == "https://kubelet:10250/portForward/default/podA?port=80"
+    assert debug_handlers.run_url == "https://kubelet:10250/run/test/test/test?cmd="
+    assert debug_handlers.logs_url == "https://kubelet:10250/logs/"
+
+
+def test_ReadOnlyKubeletPortHunter_find_privileged_containers():
+    e = ReadOnlyKubeletEvent()
+    e.host = "kubelet"
+    e.port = 10255
+    h = ReadOnlyKubeletPortHunter(e)
+    assert h.find_privileged_containers() is None
+
+    h.containers = get_containers(json.loads(pods))
+    assert h.find_privileged_containers() == [("podB", "containerC")]
+
+
+def test_SecureKubeletPortHunter_test_handlers():
+    h = SecureKubeletPortHunter(create_secure_event())
+    h.containers = get_containers(json.loads(pods))
+    published = []
+    h.publish_event = published.append
+    with requests_mock.Mocker() as m:
+        m.get("https://kubelet:10250/runningpods", text=pods)
+        m.get("https://kubelet:10250/debug/pprof/cmdline", text="kubelet --anonymous-auth=true")
+        m.get("https://kubelet:10250/containerLogs/default/podB/containerB", text="logs")
+        m.get("https://kubelet:10250/exec/default/podB/containerB", status_code=403)
+        m.get("https://kubelet:10250/run/test/test/test", status_code=405)
+        m.get("https://kubelet:10250/portForward/default/podB", status_code=403)
+        m.get("https://kubelet:10250/attach/default/podB/containerB", status_code=403)
+        m.get("https://kubelet:10250/logs/", text="<pre>\n<a href=\"audit/\">audit/</a>\n</pre>")
+        h.test_handlers()
+
+    assert [type(event).__name__ for event in published] == [
+        "ExposedRunningPodsHandler",
+        "ExposedKubeletCmdline",
+        "ExposedContainerLogsHandler",
+        "ExposedRunHandler",
+        "ExposedSystemLogs",
+    ]
+    assert published[0].count == 2
+
+
+def test_kubelet_requests_skip_verification_with_ca_bundle(monkeypatch):
+    # a session level verify=False is replaced by these, so each request has to pass it explicitly
+    monkeypatch.setenv("REQUESTS_CA_BUNDLE", "/etc/ssl/certs/ca-certificates.crt")
+    monkeypatch.setenv("CURL_CA_BUNDLE", "/etc/ssl/certs/ca-certificates.crt")
+    h = SecureKubeletPortHunter(create_secure_event())
+    h.containers = get_containers(json.loads(pods))
+    h.publish_event = lambda event: None
+    with requests_mock.Mocker() as m:
+        m.get(requests_mock.ANY, text="")
+        h.check_healthz_endpoint()
+        h.test_handlers()
+
+    assert len(m.request_history) == 9
+    assert all(request.verify is False for request in m.request_history)
+
+
+def test_get_pods_cache():
+    session = requests.Session()
+    with requests_mock.Mocker() as m:
+        pods_request = m.get(
+            "https://kubelet:10250/pods", text=pods, headers={"Content-Type": "application/json"},
+        )
+        first = get_pods(session, "https://kubelet:10250", 1)
+        assert get_pods(session, "https://kubelet:10250", 1) == first
+        assert pods_request.call_count == 1
+
+        # responses fetched with different credentials are cached separately
+        authorized_session = requests.Session()
+        authorized_session.headers.update({"Authorization": "Bearer token"})
+        get_pods(authorized_session, "https://kubelet:10250", 1)
+        assert pods_request.call_count == 2
+        assert pods_request.last_request.headers["Authorization"] == "Bearer token"
+        get_pods(authorized_session, "https://kubelet:10250", 1)
+        assert pods_request.call_count == 2
+
+
+def test_get_pods_cache_failures_are_not_cached():
+    session = requests.Session()
+    with requests_mock.Mocker() as m:
+        pods_request = m.get("https://kubelet:10250/pods", status_code=401)
+        assert get_pods(session, "https://kubelet:10250", 1) is None
+        assert get_pods(session, "https://kubelet:10250", 1) is None
+        assert pods_request.call_count == 2
+
+
+def test_get_pods_cache_ttl(monkeypatch):
+    monkeypatch.setattr(kubelet, "PODS_CACHE_TTL", 0)
+    session = requests.Session()
+    with requests_mock.Mocker() as m:
+        pods_request = m.get(
+            "https://kubelet:10250/pods", text=pods, headers={"Content-Type": "application/json"},
+        )
+        get_pods(session, "https://kubelet:10250", 1)
+        get_pods(session, "https://kubelet:10250", 1)
+        assert pods_request.call_count == 2
+
+
+def test_get_pods_cache_eviction(monkeypatch):
+    monkeypatch.setattr(kubelet, "PODS_CACHE_SIZE", 2)
+    session = requests.Session()
+    with requests_mock.Mocker() as m:
+        requests_by_host = {
+            host: m.get(f"https://{host}:10250/pods", text=pods, headers={"Content-Type": "application/json"})
+            for host in ("kubeletA", "kubeletB", "kubeletC")
+        }
+        for host in ("kubeletA", "kubeletB", "kubeletC"):
+            get_pods(session, f"https://{host}:10250", 1)
+
+        # the oldest entry was evicted to make room for kubeletC
+        get_pods(session, "https://kubeletB:10250", 1)
+        get_pods(session, "https://kubeletC:10250", 1)
+        get_pods(session, "https://kubeletA:10250", 1)
+        assert requests_by_host["kubeletA"].call_count == 2
+        assert requests_by_host["kubeletB"].call_count == 1
+        assert requests_by_host["kubeletC"].call_count == 1
+
+
+@pytest.mark.parametrize(
+    "metrics, version",
+    [
+        (
+            '# TYPE kubernetes_build_info gauge\n'
+            'kubernetes_build_info{buildDate="2020-01-01T00:00:00Z",gitVersion="v1.16.3",goVersion="go=1,2"} 1\n',
+            "v1.16.3",
+        ),
+        ('apiserver_request_total{code="200"} 1\nprocess_open_fds 12\n', None),
+        ('kubernetes_build_info{buildDate="2020-01-01T00:00:00Z",goVersion="go1.12"} 1\n', None),
+    ],
+)
+def test_ReadOnlyKubeletPortHunter_get_k8s_version(metrics, version):
+    e = ReadOnlyKubeletEvent()
+    e.host = "kubelet"
+    e.port = 10255
+    h = ReadOnlyKubeletPortHunter(e)
+    with requests_mock.Mocker() as m:
+        m.get("http://kubelet:10255/metrics", text=metrics)
+        assert h.get_k8s_version() == version
+
+
+def test_ProveSystemLogs():
+    e = ExposedSystemLogs()
+    e.previous = create_secure_event()
+    SecureKubeletPortHunter(e.previous)
+    h = ProveSystemLogs(e)
+    audit_log = (
+        # "/bin/sh\0-c\0id"
+        b"type=PROCTITLE msg=audit(1.1:1): proctitle=2F62696E2F7368002D63006964\n"
+        # odd length hex is skipped
+        b"type=PROCTITLE msg=audit(1.1:2): proctitle=2F62696\n"
+        # quoted titles aren't hex encoded, and are not matched
+        b'type=PROCTITLE msg=audit(1.1:3): proctitle="bash"\n'
+        # "ls\0\xff", invalid utf-8
+        b"type=PROCTITLE msg=audit(1.1:4): proctitle=6C7300FF\n"
+    )
+    with requests_mock.Mocker() as m:
+        m.get("https://kubelet:10250/logs/audit/audit.log", content=audit_log)
+        h.execute()
+
+    assert e.proctitles == ["/bin/sh -c id", "ls \ufffd"]